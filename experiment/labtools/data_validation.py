@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+"""
+labtools.data_validation
+
+Check a directory of data files against the expected layout, keeping a
+manifest of per-file hashes so files that haven't changed since the last
+check are not parsed again.
+"""
+import csv
+import hashlib
+import json
+import os
+from collections import defaultdict
+from multiprocessing import Pool, cpu_count
+
+import unipath
+
+MANIFEST_VERSION = 2
+
+
+def validate_data_dir(data_dir, columns, expected_rows=None, categories=None,
+                      unique=None, optional_columns=None, match='*.csv',
+                      manifest='.manifest.json', processes=None, rehash=False):
+    """
+    Validate every data file in a directory.
+
+    Files whose size and modification time match the manifest are not read
+    at all. Changed files are hashed and parsed in a single streaming pass,
+    split across a process pool.
+
+    :param data_dir: str. Directory containing the data files.
+    :param columns: list. Exact header expected in each file.
+    :param expected_rows: int, optional. Number of data rows in each file.
+    :param categories: dict, optional. Column names mapped to the values
+                       allowed in that column.
+    :param unique: str, optional. Column that should hold a single value
+                   per file, and a different value in every file, e.g.
+                   subj_id.
+    :param optional_columns: list, optional. Columns that may follow the
+                             expected columns, e.g. from optional modes.
+    :param match: str. Pattern of data files to validate.
+    :param manifest: str. Name of the manifest file, stored in data_dir.
+                     Hidden by default so it isn't picked up by compile.R.
+    :param processes: int, optional. Size of the process pool. Defaults to
+                      the number of cpus.
+    :param rehash: bool, default False. Hash every file, even those whose
+                   size and modification time are unchanged.
+    :return: dict. File names mapped to results, each with an "errors" list.
+    """
+    data_dir = unipath.Path(data_dir)
+    manifest_file = unipath.Path(data_dir, manifest)
+    headers = [columns]
+    if optional_columns:
+        headers.append(columns + list(optional_columns))
+    cached = _load_manifest(manifest_file, headers, expected_rows,
+                            categories, unique)
+
+    results = {}
+    to_check = []
+    for data_file in data_dir.listdir(match):
+        stat = os.stat(data_file)
+        prev = cached.get(data_file.name)
+        if prev and not rehash and \
+                (prev['size'], prev['mtime']) == (stat.st_size, stat.st_mtime):
+            results[data_file.name] = prev
+        else:
+            to_check.append((str(data_file), prev, headers, expected_rows,
+                             categories, unique))
+
+    if len(to_check) > 1 and processes != 1:
+        processes = processes or cpu_count()
+        chunksize = max(1, len(to_check)/(4*processes))
+        pool = Pool(processes)
+        try:
+            checked = pool.map(_check_file, to_check, chunksize=chunksize)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        checked = map(_check_file, to_check)
+
+    for result in checked:
+        results[result['name']] = result
+
+    if unique is not None:
+        _check_duplicates(results, unique)
+
+    _save_manifest(manifest_file, results, headers, expected_rows,
+                   categories, unique)
+    return results
+
+
+def _check_file(args):
+    """ Hash and validate a single file in one streaming pass. """
+    path, prev, headers, expected_rows, categories, unique = args
+    stat = os.stat(path)
+    digest = hashlib.sha1()
+
+    def _lines(f):
+        for line in f:
+            digest.update(line)
+            yield line
+
+    errors = []
+    values = set()
+    num_rows = 0
+    with open(path, 'rb') as f:
+        reader = csv.reader(_lines(f))
+        columns = next(reader, None)
+        if columns not in headers:
+            errors.append('header does not match expected columns')
+            # Drain the file so the hash is still complete.
+            for _ in reader:
+                num_rows += 1
+        else:
+            checks = [(ix, name, set(categories[name]))
+                      for ix, name in enumerate(columns)
+                      if categories and name in categories]
+            unique_ix = columns.index(unique) if unique else None
+            for row in reader:
+                num_rows += 1
+                if len(row) != len(columns):
+                    errors.append('row %d has %d fields' % (num_rows, len(row)))
+                    continue
+                for ix, name, allowed in checks:
+                    if row[ix] not in allowed:
+                        errors.append('row %d: invalid %s "%s"' %
+                                      (num_rows, name, row[ix]))
+                if unique_ix is not None:
+                    values.add(row[unique_ix])
+
+    sha1 = digest.hexdigest()
+    if prev and prev['sha1'] == sha1:
+        # Touched but not modified
+        result = dict(prev)
+        result.update(size=stat.st_size, mtime=stat.st_mtime)
+        return result
+
+    if expected_rows is not None and num_rows != expected_rows:
+        errors.append('expected %d rows, found %d' % (expected_rows, num_rows))
+    if len(values) > 1:
+        errors.append('more than one %s: %s' % (unique, sorted(values)))
+
+    return dict(name=os.path.basename(path), sha1=sha1, size=stat.st_size,
+                mtime=stat.st_mtime, rows=num_rows, errors=errors,
+                unique=sorted(values))
+
+
+def _check_duplicates(results, unique):
+    """ Flag values of the unique column that appear in more than one file.
+
+    Duplicate errors are recomputed on every run, so they are kept separate
+    from the per-file errors stored in the manifest.
+    """
+    owners = defaultdict(list)
+    for name, result in results.items():
+        for value in result['unique']:
+            owners[value].append(name)
+
+    for result in results.values():
+        result['duplicates'] = []
+    for value, names in owners.items():
+        if len(names) > 1:
+            for name in names:
+                others = sorted(set(names) - {name})
+                results[name]['duplicates'].append(
+                    'duplicate %s "%s" in %s' % (unique, value,
+                                                 ', '.join(others))
+                )
+
+
+def _settings_key(headers, expected_rows, categories, unique):
+    settings = dict(headers=headers, expected_rows=expected_rows,
+                    categories={k: sorted(v)
+                                for k, v in (categories or {}).items()},
+                    unique=unique, version=MANIFEST_VERSION)
+    return hashlib.sha1(json.dumps(settings, sort_keys=True)).hexdigest()
+
+
+def _load_manifest(manifest_file, *settings):
+    """ Load cached results, discarding them if the checks have changed. """
+    try:
+        with open(manifest_file, 'r') as f:
+            manifest = json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+    if manifest.get('settings') != _settings_key(*settings):
+        return {}
+    return manifest['files']
+
+
+def _save_manifest(manifest_file, results, *settings):
+    files = {}
+    for name, result in results.items():
+        files[name] = {k: v for k, v in result.items() if k != 'duplicates'}
+    manifest = dict(settings=_settings_key(*settings), files=files)
+
+    tmp_file = manifest_file + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.rename(tmp_file, manifest_file)
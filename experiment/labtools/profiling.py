@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+"""
+labtools.profiling
+
+Opt-in profiling of chosen phases of an experiment, e.g. the code between
+trials, without profiling stimulus presentation.
+
+    profiler = PhaseProfiler(enabled=True)
+    for block in trials.iter_blocks():
+        profiler.block = block[0]['block']
+        for trial in block:
+            trial_data = experiment.run_trial(trial)
+            with profiler.phase('inter_trial'):
+                participant.write_trial(trial_data)
+    profiler.write('profiles', prefix=participant['subj_id'])
+
+Results are written as collapsed stacks, one file per block, which can be
+passed directly to flamegraph.pl.
+"""
+import os
+import sys
+from collections import defaultdict, Counter
+from timeit import default_timer
+
+import unipath
+
+
+class _NullPhase(object):
+    """ Shared context manager used when profiling is off. """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_NULL_PHASE = _NullPhase()
+
+
+class PhaseProfiler(object):
+    """ Deterministic profiler that only runs inside named phases.
+
+    When the profiler is disabled, phase returns a shared no-op context
+    manager, so leaving the hooks in place costs a single method call.
+    """
+    def __init__(self, enabled=False, phases=None):
+        """
+        :param enabled: bool, default False. Turn profiling on.
+        :param phases: list of str, optional. Only profile these phases.
+                       Defaults to all phases.
+        """
+        self.enabled = enabled
+        self.phases = set(phases) if phases else None
+        self.block = None
+        self.stacks = defaultdict(Counter)
+
+    def phase(self, name):
+        """ Context manager profiling everything called inside it. """
+        if not self.enabled or \
+                (self.phases is not None and name not in self.phases):
+            return _NULL_PHASE
+        return _Phase(self, name)
+
+    def record(self, stack, seconds):
+        self.stacks[self.block][stack] += seconds
+
+    def write(self, out_dir='profiles', prefix='profile'):
+        """ Write collapsed stacks per block and for the whole session.
+
+        Counts are in microseconds. Returns the paths written.
+        """
+        out_dir = unipath.Path(out_dir)
+        if not out_dir.exists():
+            out_dir.mkdir(parents=True)
+
+        total = Counter()
+        written = []
+        for block, stacks in sorted(self.stacks.items()):
+            total.update(stacks)
+            folded = unipath.Path(out_dir,
+                                  '{}-block{}.folded'.format(prefix, block))
+            self._write_folded(folded, stacks)
+            written.append(folded)
+
+        folded = unipath.Path(out_dir, '{}-all.folded'.format(prefix))
+        self._write_folded(folded, total)
+        written.append(folded)
+        return written
+
+    def summary(self):
+        """ Total seconds spent in each phase, per block. """
+        totals = defaultdict(Counter)
+        for block, stacks in self.stacks.items():
+            for stack, seconds in stacks.items():
+                totals[block][stack.split(';', 1)[0]] += seconds
+        return totals
+
+    @staticmethod
+    def _write_folded(path, stacks):
+        with open(path, 'w') as f:
+            for stack, seconds in sorted(stacks.items()):
+                microseconds = int(round(seconds * 1e6))
+                if microseconds > 0:
+                    f.write('{} {}\n'.format(stack, microseconds))
+
+
+class _Phase(object):
+    """ Track the call stack inside a phase with sys.setprofile. """
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        # Each entry is [label, start time, time spent in children]
+        self._stack = [[self.name, default_timer(), 0.0]]
+        sys.setprofile(self._trace)
+        return self
+
+    def __exit__(self, *exc_info):
+        sys.setprofile(None)
+        now = default_timer()
+        while len(self._stack) > 1:
+            self._pop(now)
+        _, start, children = self._stack[0]
+        self.profiler.record(self.name, now - start - children)
+        return False
+
+    def _trace(self, frame, event, arg):
+        if event == 'call':
+            code = frame.f_code
+            if code is _EXIT_CODE:
+                # Stop before the profiler's own exit is recorded
+                sys.setprofile(None)
+                return
+            label = '{} ({}:{})'.format(code.co_name,
+                                        os.path.basename(code.co_filename),
+                                        code.co_firstlineno)
+            self._stack.append([label, default_timer(), 0.0])
+        elif event == 'c_call':
+            module = getattr(arg, '__module__', None) or 'builtins'
+            label = '{}.{}'.format(module, arg.__name__)
+            self._stack.append([label, default_timer(), 0.0])
+        elif len(self._stack) > 1:
+            # return, c_return, c_exception
+            self._pop(default_timer())
+
+    def _pop(self, now):
+        label, start, children = self._stack.pop()
+        elapsed = now - start
+        stack = ';'.join(entry[0] for entry in self._stack)
+        self.profiler.record(stack + ';' + label, elapsed - children)
+        self._stack[-1][2] += elapsed
+
+_EXIT_CODE = _Phase.__exit__.__func__.__code__
@@ -8,7 +8,8 @@ import yaml
 
 from psychopy import core, event, visual, data, gui, misc, sound
 
-def get_subj_info(gui_yaml, check_exists, save_order=True):
+def get_subj_info(gui_yaml, check_exists, save_order=True, defaults=None,
+                  fixed=None):
     """ Create a psychopy.gui from a yaml config file.
 
     The first time the experiment is run, a pickle of that subject's settings
@@ -22,6 +23,10 @@ def get_subj_info(gui_yaml, check_exists, save_order=True):
         checks for its existence. If the file exists, an error is displayed.
     save_order: bool, Should the key order be saved in "_order"? Defaults to
         True.
+    defaults: dict, optional. Values that take precedence over both the
+        yaml defaults and the last participant's options.
+    fixed: list, optional. Names of gui fields that can't be edited, e.g.
+        because their values were assigned elsewhere.
 
     Returns
     -------
@@ -47,6 +52,9 @@ def get_subj_info(gui_yaml, check_exists, save_order=True):
     except IOError, AssertionError:
         gui_data = {field['name']: field['default'] for field in ordered_fields}
 
+    if defaults:
+        gui_data.update(defaults)
+
     # Set fixed fields
     gui_data['date'] = data.getDateStr()
     gui_data['computer'] = socket.gethostname()
@@ -55,7 +63,8 @@ def get_subj_info(gui_yaml, check_exists, save_order=True):
     while True:
         # Bring up the dialogue
         dlg = gui.DlgFromDict(gui_data, order=ordered_names,
-                              fixed=fixed_fields, tip=field_tips)
+                              fixed=fixed_fields + list(fixed or []),
+                              tip=field_tips)
 
         if not dlg.OK:
             core.quit()
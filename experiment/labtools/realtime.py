@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+"""
+labtools.realtime
+
+Keep garbage collection and the OS scheduler from pausing the experiment
+during stimulus presentation.
+"""
+import ctypes
+import ctypes.util
+import gc
+import os
+import sys
+
+
+def raise_priority(increment=-10):
+    """ Lower the niceness of this process. Returns True if it worked.
+
+    Only attempted on Linux, where a negative increment needs root or
+    CAP_SYS_NICE.
+    """
+    if not sys.platform.startswith('linux'):
+        return False
+    try:
+        os.nice(increment)
+    except OSError:
+        return False
+    return True
+
+
+# cpu_set_t in glibc holds 1024 cpus
+_CPU_SETSIZE = 1024
+_MASK_BITS = 8 * ctypes.sizeof(ctypes.c_ulong)
+_CpuMask = ctypes.c_ulong * (_CPU_SETSIZE / _MASK_BITS)
+
+
+def _libc():
+    libc_name = ctypes.util.find_library('c') or 'libc.so.6'
+    return ctypes.CDLL(libc_name, use_errno=True)
+
+
+def pin_cpu(cpu=None):
+    """ Pin this process to a single cpu. Returns True if it worked.
+
+    Defaults to the last cpu this process may run on, which is the least
+    likely to be handling interrupts. Only attempted on Linux, where
+    sched_setaffinity is called through libc, since Python 2 has no
+    os.sched_setaffinity.
+    """
+    if not sys.platform.startswith('linux'):
+        return False
+    try:
+        libc = _libc()
+        mask = _CpuMask()
+        if libc.sched_getaffinity(0, ctypes.sizeof(mask),
+                                  ctypes.byref(mask)) != 0:
+            return False
+        allowed = [ix for ix in range(_CPU_SETSIZE)
+                   if mask[ix / _MASK_BITS] & (1 << (ix % _MASK_BITS))]
+        if cpu is None:
+            cpu = allowed[-1]
+
+        mask = _CpuMask()
+        mask[cpu / _MASK_BITS] = 1 << (cpu % _MASK_BITS)
+        return libc.sched_setaffinity(0, ctypes.sizeof(mask),
+                                      ctypes.byref(mask)) == 0
+    except (OSError, IndexError):
+        return False
+
+
+class RealtimeMode(object):
+    """ Disable garbage collection during presentation and collect between
+    trials. Priority and cpu affinity are set once, when enabled.
+    """
+    COLUMNS = ['rt_gc_disabled', 'rt_priority', 'rt_affinity']
+
+    def __init__(self, enabled=False, increment=-10, cpu=None):
+        self.enabled = enabled
+        self.priority = enabled and raise_priority(increment)
+        self.affinity = enabled and pin_cpu(cpu)
+        self._gc_disabled = False
+
+    def begin_presentation(self):
+        self._gc_disabled = False
+        if self.enabled and gc.isenabled():
+            gc.disable()
+            self._gc_disabled = True
+
+    def end_presentation(self):
+        if self._gc_disabled:
+            gc.enable()
+
+    def collect(self):
+        """ Run a full collection, e.g. during the ITI or a block break. """
+        if self.enabled:
+            gc.collect()
+
+    def status(self):
+        """ Which controls applied to the last presentation. """
+        return dict(rt_gc_disabled=int(self._gc_disabled),
+                    rt_priority=int(bool(self.priority)),
+                    rt_affinity=int(bool(self.affinity)))
+
+
+def measure_jitter(realtime, win, stims, n=200, frames_per_trial=60,
+                   garbage=200):
+    """
+    Time draw and flip cycles, the way run_trial presents stimuli.
+
+    Frames are grouped into trials. The mode is applied around each trial
+    and collects between trials, as in run_trial.
+
+    :param realtime: RealtimeMode. Mode used around each trial.
+    :param win: psychopy.visual.Window. Window to flip.
+    :param stims: list. Stimuli drawn on every frame.
+    :param n: int. Number of frames to time.
+    :param frames_per_trial: int. Frames between collections.
+    :param garbage: int. Reference cycles created on each frame, a stand-in
+                    for the allocations made by the trial loop.
+    :return: list of float. Time between flips in milliseconds.
+    """
+    intervals = []
+    while len(intervals) < n:
+        realtime.begin_presentation()
+        last_flip = win.flip()
+        for _ in range(frames_per_trial):
+            for _ in range(garbage):
+                cycle = []
+                cycle.append(cycle)
+            for stim in stims:
+                stim.draw()
+            flip = win.flip()
+            intervals.append((flip - last_flip) * 1000)
+            last_flip = flip
+        realtime.end_presentation()
+        realtime.collect()
+    return intervals[:n]
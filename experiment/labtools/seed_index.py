@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+"""
+labtools.seed_index
+
+Precompute the design properties of the trials generated by each seed, and
+allocate seeds that meet balance criteria.
+"""
+import csv
+from collections import deque
+
+import pandas as pd
+import unipath
+
+from .session_log import read_header
+
+
+def build_seed_index(make_trials, summarize, seeds, index_csv=None):
+    """
+    Summarize the trials generated by each seed.
+
+    :param make_trials: function. Takes a seed and returns trials.
+    :param summarize: function. Takes trials and returns a dict of design
+                      properties.
+    :param seeds: iterable of int. Seeds to include in the index.
+    :param index_csv: str, optional. If provided, the index is saved here.
+    :return: pandas.DataFrame. One row per seed.
+    """
+    records = []
+    for seed in seeds:
+        summary = summarize(make_trials(seed))
+        summary['seed'] = seed
+        records.append(summary)
+
+    index = pd.DataFrame.from_records(records)
+    index = index[['seed'] + sorted(set(index.columns) - {'seed'})]
+
+    if index_csv is not None:
+        index.to_csv(index_csv, index=False)
+    return index
+
+
+def used_seeds(data_dir, log_dir=None, match='*.csv', log_match='*.bin',
+               key='seed'):
+    """ Collect the seeds recorded in the data files in a directory.
+
+    Binary session logs in log_dir are included, since a session that was
+    logged in binary and ended early has no csv.
+    """
+    seeds = set()
+
+    data_dir = unipath.Path(data_dir)
+    if data_dir.exists():
+        for data_file in data_dir.listdir(match):
+            with open(data_file, 'r') as f:
+                first_trial = next(csv.DictReader(f), None)
+            if first_trial is not None:
+                seeds.add(int(first_trial[key]))
+
+    if log_dir is not None and unipath.Path(log_dir).exists():
+        for log_file in unipath.Path(log_dir).listdir(log_match):
+            header, _ = read_header(log_file)
+            seeds.add(int(header['participant'][key]))
+    return seeds
+
+
+class SeedAllocator(object):
+    """ Hand out unused seeds that meet balance criteria.
+
+    Seeds are filtered once when the allocator is created. After that,
+    next_seed is amortized O(1): used seeds are popped off the front of the
+    queue and never looked at again.
+    """
+    def __init__(self, index, max_values=None, used=None):
+        """
+        :param index: pandas.DataFrame or str. Seed index, or the path to a
+                      csv created by build_seed_index.
+        :param max_values: dict, optional. Column names in the index mapped
+                           to the largest acceptable value.
+        :param used: iterable of int, optional. Seeds that are already taken.
+        """
+        if not isinstance(index, pd.DataFrame):
+            index = pd.read_csv(index)
+
+        balanced = pd.Series(True, index=index.index)
+        for name, max_value in (max_values or {}).items():
+            balanced &= index[name] <= max_value
+
+        self._available = deque(int(seed) for seed in index.seed[balanced])
+        self._used = set(used or [])
+
+    def __len__(self):
+        return len([s for s in self._available if s not in self._used])
+
+    def peek(self):
+        """ Return the next unused seed without marking it as used. """
+        while self._available and self._available[0] in self._used:
+            self._available.popleft()
+
+        if not self._available:
+            raise ValueError('no balanced seeds left in the index')
+        return self._available[0]
+
+    def next_seed(self):
+        """ Return the next unused seed and mark it as used. """
+        seed = self.peek()
+        self.use(seed)
+        return seed
+
+    def use(self, seed):
+        self._used.add(seed)
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+"""
+labtools.session_log
+
+Append-only binary log of trials with fixed-width typed records.
+
+The file starts with a header holding the participant fields and the column
+types, followed by one record per trial. Floats are stored as float64, ints
+as int32, and strings as uint8 codes into a fixed list of categories, so the
+records can be memory-mapped with numpy while a session is still running.
+export_csv writes the same csv that Participant writes.
+"""
+import json
+import os
+import struct
+
+import numpy as np
+
+MAGIC = 'LABLOG01'
+_HEADER_LEN = struct.Struct('<I')
+
+# Blank values ('') are stored as these
+MISSING_INT = -2**31
+MISSING_CODE = 255
+
+
+def _record_dtype(columns, dtypes):
+    # Names read back from the json header are unicode, which older
+    # versions of numpy don't accept as field names.
+    fields = []
+    for name in columns:
+        kind = dtypes[name]
+        if kind == 'float':
+            fields.append((str(name), '<f8'))
+        elif kind == 'int':
+            fields.append((str(name), '<i4'))
+        else:
+            if len(kind) >= MISSING_CODE:
+                raise ValueError('too many categories for %s' % name)
+            fields.append((str(name), 'u1'))
+    return np.dtype(fields)
+
+
+class SessionLog(object):
+    """ Append trials to a binary session log. """
+    def __init__(self, path, participant, order, columns, dtypes):
+        """
+        :param path: str. Log file to create.
+        :param participant: dict. Participant fields, written to the header.
+        :param order: list. Order of the participant fields.
+        :param columns: list. Trial columns, one field in each record.
+        :param dtypes: dict. Trial columns mapped to 'float', 'int', or a
+                       list of the strings allowed in that column.
+        """
+        self.columns = list(columns)
+        self.dtypes = {name: dtypes[name] for name in self.columns}
+        self._codes = {name: {value: code for code, value in enumerate(kind)}
+                       for name, kind in self.dtypes.items()
+                       if kind not in ('float', 'int')}
+
+        dtype = _record_dtype(self.columns, self.dtypes)
+        self._struct = struct.Struct(
+            '<' + ''.join(dtype[name].char for name in self.columns)
+        )
+
+        header = json.dumps(dict(participant=participant, order=list(order),
+                                 columns=self.columns, dtypes=self.dtypes))
+        # Pad so the records start on an 8-byte boundary
+        header_size = len(MAGIC) + _HEADER_LEN.size + len(header)
+        header += ' ' * (-header_size % 8)
+
+        self._file = open(path, 'wb')
+        self._file.write(MAGIC)
+        self._file.write(_HEADER_LEN.pack(len(header)))
+        self._file.write(header)
+        self._file.flush()
+
+    def append(self, trial):
+        """ Write a trial as a single record. """
+        values = []
+        for name in self.columns:
+            value = trial[name]
+            kind = self.dtypes[name]
+            if kind == 'float':
+                values.append(float('nan') if value == '' else float(value))
+            elif kind == 'int':
+                values.append(MISSING_INT if value == '' else int(value))
+            elif value == '':
+                values.append(MISSING_CODE)
+            else:
+                try:
+                    values.append(self._codes[name][value])
+                except KeyError:
+                    raise ValueError('%s is not a valid %s' % (value, name))
+        self._file.write(self._struct.pack(*values))
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def read_header(path):
+    """ Read the header of a session log without touching the records.
+
+    :return: (dict, int). Header and the offset of the first record.
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('%s is not a session log' % path)
+        header_len, = _HEADER_LEN.unpack(f.read(_HEADER_LEN.size))
+        header = json.loads(f.read(header_len))
+        return header, f.tell()
+
+
+def read_session_log(path):
+    """
+    Memory-map the records in a session log.
+
+    Only complete records are mapped, so a log can be read while a session
+    is still appending to it.
+
+    :return: (dict, numpy.memmap). Header and structured array of records.
+    """
+    header, offset = read_header(path)
+    data_size = os.path.getsize(path) - offset
+
+    dtype = _record_dtype(header['columns'], header['dtypes'])
+    num_records = data_size // dtype.itemsize
+    if num_records == 0:
+        return header, np.zeros(0, dtype=dtype)
+    records = np.memmap(path, dtype=dtype, mode='r', offset=offset,
+                        shape=(num_records, ))
+    return header, records
+
+
+def export_csv(log_path, csv_path, delimiter=','):
+    """ Write a session log in the csv layout written by Participant. """
+    header, records = read_session_log(log_path)
+    participant = header['participant']
+    order = header['order']
+    columns = header['columns']
+    dtypes = header['dtypes']
+
+    participant_values = [str(participant[name]) for name in order]
+
+    with open(csv_path, 'w') as f:
+        f.write(delimiter.join(order + columns) + '\n')
+        for record in records:
+            row = list(participant_values)
+            for name in columns:
+                value = record[str(name)]
+                kind = dtypes[name]
+                if kind == 'float':
+                    row.append('' if np.isnan(value) else str(float(value)))
+                elif kind == 'int':
+                    row.append('' if value == MISSING_INT else str(int(value)))
+                else:
+                    row.append('' if value == MISSING_CODE else
+                               str(kind[value]))
+            f.write(delimiter.join(row) + '\n')
+
+
+if __name__ == '__main__':
+    # Check that a log exports to the csv that Participant would write:
+    #     python -m labtools.session_log
+    import shutil
+    import tempfile
+
+    participant = dict(subj_id='MAR000', seed=1)
+    order = ['subj_id', 'seed']
+    columns = ['trial', 'rt', 'response']
+    dtypes = dict(trial='int', rt='float', response=['left', 'right'])
+    trials = [dict(trial=0, rt=512.25, response='left'),
+              dict(trial=1, rt=1500.0, response='right'),
+              dict(trial=2, rt='', response='')]
+
+    expected = [','.join(order + columns)]
+    for trial in trials:
+        values = [participant[name] for name in order]
+        values += [trial[name] for name in columns]
+        expected.append(','.join(str(value) for value in values))
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        log_path = os.path.join(tmp_dir, 'MAR000.bin')
+        csv_path = os.path.join(tmp_dir, 'MAR000.csv')
+        log = SessionLog(log_path, participant, order, columns, dtypes)
+        for trial in trials:
+            log.append(trial)
+        log.close()
+        export_csv(log_path, csv_path)
+        with open(csv_path, 'r') as f:
+            exported = f.read().splitlines()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    assert exported == expected, '\n'.join(exported)
+    print('session log round trip ok')
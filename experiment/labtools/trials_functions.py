@@ -14,24 +14,146 @@ def counterbalance(conditions, order=None):
     
     Each row of the resulting DataFrame contains a unique combination of 
     conditions. Use primarily for full counterbalancing of within-subject 
-    variables.
+    variables. For designs too large to hold in memory, use DesignSpace.
     
     :param conditions: dict. Variable names and possible values.
     :param order: list, optional. Order of columns in output.
     :return: pandas.DataFrame. Each row is a unique combination of variables, 
              assuming the possible values for each variable are unique.
     """
-    for k,v in conditions.items():
-        if not hasattr(v, '__iter__'):
-            conditions[k] = [v]
+    return DesignSpace(conditions, order=order).to_frame()
+
+class DesignSpace(object):
+    """
+    Lazy view of all independent variable combinations.
+    
+    Combinations are in the same order as counterbalance, but are only 
+    generated as they are needed, so memory scales with the chunk size 
+    rather than the total size of the design.
     
-    combinations = list(itls.product(*conditions.values()))
-    frame = pd.DataFrame(combinations, columns=conditions.keys())
+        >>> design = DesignSpace(dict(a=[1,2], b=['x','y','z']))
+        >>> len(design)
+        6
+        >>> design[4]
+        {'a': 2, 'b': 'y'}
+    """
+    def __init__(self, conditions, order=None):
+        """
+        :param conditions: dict. Variable names and possible values. Not 
+                           modified.
+        :param order: list, optional. Order of columns in output.
+        """
+        self.names = list(conditions.keys())
+        self.levels = []
+        for name in self.names:
+            values = conditions[name]
+            if not hasattr(values, '__iter__'):
+                values = [values]
+            self.levels.append(list(values))
+        self.order = list(order) if order is not None else self.names
+    
+    def __len__(self):
+        return reduce(lambda total, levels: total*len(levels), self.levels, 1)
     
-    if order is None:
-        order = frame.columns
+    def __getitem__(self, n):
+        """ Compute the n-th combination directly, without iterating. """
+        size = len(self)
+        if n < 0:
+            n += size
+        if not 0 <= n < size:
+            raise IndexError('combination %d out of range' % n)
+        
+        # The last variable changes fastest, as in itertools.product
+        values = {}
+        for name, levels in reversed(zip(self.names, self.levels)):
+            n, ix = divmod(n, len(levels))
+            values[name] = levels[ix]
+        return values
+    
+    def iter_chunks(self, chunk_size=10000, where=None):
+        """
+        Yield combinations as DataFrames of at most chunk_size rows.
+        
+        :param chunk_size: int. Number of combinations generated at a time.
+        :param where: function, optional. Takes a chunk and returns a boolean 
+                      Series of the rows to keep. Empty chunks are skipped.
+        """
+        combinations = itls.product(*self.levels)
+        start = 0
+        while True:
+            rows = list(itls.islice(combinations, chunk_size))
+            if not rows:
+                break
+            index = range(start, start + len(rows))
+            start += len(rows)
+            
+            chunk = pd.DataFrame(rows, columns=self.names, index=index)
+            chunk = chunk[self.order]
+            if where is not None:
+                chunk = chunk[where(chunk)]
+            if len(chunk):
+                yield chunk
+    
+    def apply(self, func, chunk_size=10000, where=None, **kwargs):
+        """
+        Hand off chunks of combinations to a function, e.g. expand or extend.
+        
+        :param func: function. Called as func(chunk, **kwargs).
+        :return: generator of the results for each chunk.
+        """
+        for chunk in self.iter_chunks(chunk_size, where=where):
+            yield func(chunk, **kwargs)
+    
+    def sample(self, n, seed=None, where=None, chunk_size=10000):
+        """
+        Sample combinations without replacement.
+        
+        Without a filter, only the sampled combinations are generated. With 
+        a filter, the design is streamed in chunks, keeping the n rows with 
+        the smallest random keys so far.
+        
+        :param n: int. Number of combinations to sample.
+        :param seed: int, optional. Seed for sampling.
+        :param where: function, optional. Same as in iter_chunks.
+        :return: pandas.DataFrame. Sampled combinations, indexed by their 
+                 position in the design.
+        """
+        prng = np.random.RandomState(seed)
+        
+        if where is None:
+            size = len(self)
+            if n > size:
+                raise ValueError('cannot sample %d of %d combinations' % 
+                                 (n, size))
+            if 2*n > size:
+                ix = prng.choice(size, n, replace=False)
+            else:
+                ix = set()
+                while len(ix) < n:
+                    # int64 so large designs work where C long is 32-bit
+                    ix.update(prng.randint(0, size, n - len(ix),
+                                           dtype=np.int64))
+            ix = sorted(ix)
+            frame = pd.DataFrame([self[i] for i in ix], index=ix)
+            return frame[self.order]
+        
+        kept = None
+        for chunk in self.iter_chunks(chunk_size, where=where):
+            chunk = chunk.copy()
+            chunk['_key'] = prng.random_sample(len(chunk))
+            if kept is not None:
+                chunk = pd.concat([kept, chunk])
+            kept = chunk.sort('_key')[:n]
+        
+        if kept is None or len(kept) < n:
+            raise ValueError('fewer than %d combinations match' % n)
+        return kept.drop('_key', axis=1).sort_index()
     
-    return frame[order]
+    def to_frame(self):
+        """ Materialize every combination in a single DataFrame. """
+        rows = list(itls.product(*self.levels))
+        frame = pd.DataFrame(rows, columns=self.names)
+        return frame[self.order]
     
 def expand(valid, name, values=[1.,0.], ratio=0.5, sample=False, seed=None):
     """
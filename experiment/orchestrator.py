@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+""" Hand out subject ids and seeds to testing stations over a socket.
+
+Run the orchestrator on one machine in the lab:
+
+    python orchestrator.py serve --port 8642 --store central_data
+
+Then start each station against it:
+
+    python run.py main --orchestrator labserver:8642
+
+Stations keep writing to their own local data directory while a session is
+running. When a session finishes, the station sends the completed data file
+to the orchestrator, which is the only process that writes to the central
+store.
+"""
+import json
+import os
+import socket
+import tempfile
+import threading
+import SocketServer
+
+import unipath
+
+
+class Orchestrator(object):
+    """ Keep track of which station is running which session. """
+    # Hidden, like the validation manifest, so compile.R skips it
+    SESSIONS_FILE = '.sessions.json'
+
+    def __init__(self, store_dir, prefix='MAR', first=101, seeds=None):
+        """
+        :param store_dir: str. Central directory for completed data files.
+        :param prefix: str. Subject ids are the prefix and a number.
+        :param first: int. Number of the first subject.
+        :param seeds: labtools.seed_index.SeedAllocator, optional. Where to
+                      get balanced seeds. Without one, the seed is the
+                      subject number.
+        """
+        self.store_dir = unipath.Path(store_dir)
+        if not self.store_dir.exists():
+            self.store_dir.mkdir(parents=True)
+
+        self.prefix = prefix
+        self.seeds = seeds
+        self._lock = threading.Lock()
+
+        sessions_file = unipath.Path(self.store_dir, self.SESSIONS_FILE)
+        try:
+            with open(sessions_file, 'r') as f:
+                self.sessions = json.load(f)
+        except IOError:
+            self.sessions = {}
+
+        # Continue numbering after any subject already assigned or stored.
+        taken = [first - 1]
+        taken.extend(self._subj_num(subj_id) for subj_id in self.sessions)
+        for data_file in self.store_dir.listdir(prefix + '*.csv'):
+            taken.append(self._subj_num(data_file.stem))
+        self._next_num = max(taken) + 1
+
+        if self.seeds is not None:
+            for session in self.sessions.values():
+                self.seeds.use(session['seed'])
+
+    def handle(self, message):
+        """ Dispatch a request from a station. """
+        command = message['command']
+        if command == 'checkout':
+            return self.checkout(message['station'])
+        elif command == 'submit':
+            return self.submit(message['station'], message['subj_id'],
+                               message['data'])
+        elif command == 'status':
+            with self._lock:
+                sessions = {subj_id: dict(session)
+                            for subj_id, session in self.sessions.items()}
+            return dict(sessions=sessions)
+        else:
+            raise ValueError('%s is not a valid command' % command)
+
+    def checkout(self, station):
+        """ Assign the next subject id and seed to a station.
+
+        Any session the station was still running is marked as abandoned.
+        """
+        with self._lock:
+            for session in self.sessions.values():
+                if session['station'] == station and \
+                        session['status'] == 'running':
+                    session['status'] = 'abandoned'
+
+            subj_num = self._next_num
+            seed = subj_num
+            if self.seeds is not None:
+                try:
+                    seed = self.seeds.next_seed()
+                except ValueError:
+                    print('Warning: no balanced seeds left, using the '
+                          'subject number as the seed')
+            self._next_num += 1
+
+            subj_id = '{}{}'.format(self.prefix, subj_num)
+            session = dict(subj_id=subj_id, seed=seed, station=station,
+                           status='running')
+            self.sessions[subj_id] = session
+            self._save_sessions()
+        return dict(session)
+
+    def submit(self, station, subj_id, data):
+        """ Move a completed data file into the central store. """
+        data_file = unipath.Path(self.store_dir, '{}.csv'.format(subj_id))
+        with self._lock:
+            if subj_id not in self.sessions:
+                raise ValueError('%s was never checked out' % subj_id)
+            self._write_atomic(data_file, data)
+
+            session = self.sessions[subj_id]
+            session['station'] = station
+            session['status'] = 'complete'
+            self._save_sessions()
+        return dict(session)
+
+    def _save_sessions(self):
+        sessions_file = unipath.Path(self.store_dir, self.SESSIONS_FILE)
+        self._write_atomic(sessions_file, json.dumps(self.sessions, indent=2))
+
+    def _subj_num(self, subj_id):
+        return int(subj_id[len(self.prefix):])
+
+    @staticmethod
+    def _write_atomic(path, contents):
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix='.',
+                                        suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            f.write(contents)
+        os.chmod(tmp_path, 0o644)  # mkstemp files are only user-readable
+        os.rename(tmp_path, path)
+
+
+class _StationHandler(SocketServer.StreamRequestHandler):
+    """ Read one json request per connection and reply with json. """
+    def handle(self):
+        try:
+            message = json.loads(self.rfile.readline())
+            reply = self.server.orchestrator.handle(message)
+        except (KeyError, ValueError) as e:
+            reply = dict(error=str(e))
+        self.wfile.write(json.dumps(reply) + '\n')
+
+
+class OrchestratorServer(SocketServer.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, orchestrator):
+        SocketServer.ThreadingTCPServer.__init__(self, address,
+                                                 _StationHandler)
+        self.orchestrator = orchestrator
+
+
+def parse_address(address):
+    """ Convert "host:port" into a (host, port) tuple. """
+    host, port = address.rsplit(':', 1)
+    return host, int(port)
+
+
+def request(address, **message):
+    """ Send a single request to the orchestrator and return its reply. """
+    conn = socket.create_connection(parse_address(address), timeout=30)
+    try:
+        conn.sendall(json.dumps(message) + '\n')
+        reply = json.loads(conn.makefile('r').readline())
+    finally:
+        conn.close()
+
+    if 'error' in reply:
+        raise RuntimeError('orchestrator: %s' % reply['error'])
+    return reply
+
+
+def checkout(address, station):
+    """ Ask the orchestrator for the next subject id and seed. """
+    return request(address, command='checkout', station=station)
+
+
+def submit(address, station, subj_id, data_file):
+    """ Send a completed data file to the orchestrator. """
+    with open(data_file, 'r') as f:
+        data = f.read()
+    return request(address, command='submit', station=station,
+                   subj_id=subj_id, data=data)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['serve', 'status'])
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8642)
+    parser.add_argument('--store', default='central_data')
+    parser.add_argument('--prefix', default='MAR')
+    parser.add_argument('--first', type=int, default=101)
+    parser.add_argument('--seeds', default='seeds.csv',
+                        help='seed index made by run.py makeseeds')
+    parser.add_argument('--settings', default='settings.yaml')
+
+    args = parser.parse_args()
+    if args.command == 'serve':
+        seeds = None
+        if not unipath.Path(args.seeds).exists():
+            print('No seed index at {}, seeds are not balanced. Make one '
+                  'with run.py makeseeds.'.format(args.seeds))
+        else:
+            import yaml
+            from labtools.seed_index import SeedAllocator
+            with open(args.settings, 'r') as f:
+                seed_balance = yaml.load(f)['seed_balance']
+            seeds = SeedAllocator(args.seeds, max_values=seed_balance)
+
+        orchestrator = Orchestrator(args.store, prefix=args.prefix,
+                                    first=args.first, seeds=seeds)
+        server = OrchestratorServer((args.host, args.port), orchestrator)
+        server.serve_forever()
+    elif args.command == 'status':
+        address = '{}:{}'.format(args.host, args.port)
+        sessions = request(address, command='status')['sessions']
+        for subj_id, session in sorted(sessions.items()):
+            print('{subj_id}\t{seed}\t{station}\t{status}'.format(**session))
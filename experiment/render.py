@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+""" Render the trials in a data file without a display.
+
+Each trial's frames, cue, and target are drawn at the positions recorded in
+the data file, using the layout in settings.yaml and the same stimuli as
+run.py, so the data can be checked against what was on screen.
+
+    python render.py data/MAR101.csv data/MAR102.csv --out renders
+
+Trials are rendered across a process pool. Each data file also gets a
+contact sheet with a thumbnail of every trial.
+"""
+import csv
+import math
+from multiprocessing import Pool
+
+import unipath
+import yaml
+from PIL import Image, ImageDraw, ImageFont
+
+STIM_DIR = 'stimuli'
+
+_renderer = None
+
+
+class TrialRenderer(object):
+    """ Draw trials the way Experiment.run_trial presents them. """
+    def __init__(self, settings_yaml='settings.yaml', size=(1920, 1080),
+                 font_file=None):
+        with open(settings_yaml, 'r') as f:
+            settings = yaml.load(f)
+        layout = settings['layout']
+        self.positions = layout['positions']
+        self.frame_size = layout['frame_size']
+        self.size = tuple(size)
+
+        # Stimulus parameters are shared with Experiment
+        stimuli = settings['stimuli']
+        self.background = tuple(int(round((c + 1) * 127.5))
+                                for c in stimuli['background'])
+        self.line_width = int(math.ceil(stimuli['line_width']))
+        self.target_radius = stimuli['target_radius']
+        self.target_opacity = stimuli['target_opacity']
+
+        self.arrows = {}
+        for direction in ['left', 'right']:
+            arrow_png = unipath.Path(STIM_DIR, 'arrows',
+                                     'arrow-{}.png'.format(direction))
+            self.arrows[direction] = Image.open(arrow_png).convert('RGBA')
+
+        # Word cues are only checkable at the size shown on screen, so
+        # there is no fallback to a default font.
+        font_file = font_file or stimuli['font_file']
+        try:
+            self.font = ImageFont.truetype(font_file, stimuli['text_height'])
+        except IOError:
+            raise IOError('cannot open font %s, give the path to a copy of '
+                          '%s with --font' % (font_file, stimuli['font']))
+
+    def to_image(self, pos):
+        """ Convert centered pixel units (y up) to image coordinates. """
+        x, y = pos
+        return self.size[0]/2.0 + x, self.size[1]/2.0 - y
+
+    def render(self, trial):
+        """ Draw a trial. Returns a PIL.Image, see numpy.asarray for arrays. """
+        image = Image.new('RGBA', self.size, self.background + (255, ))
+        draw = ImageDraw.Draw(image)
+
+        half_frame = self.frame_size/2.0
+        for direction in ['left', 'right']:
+            x, y = self.to_image(self.positions[direction])
+            draw.rectangle([x - half_frame, y - half_frame,
+                            x + half_frame, y + half_frame],
+                           outline='black', width=self.line_width)
+
+        cue_x, cue_y = self.to_image((0, float(trial['cue_pos_y'])))
+        if trial['cue_type'] == 'arrow':
+            arrow = self.arrows[trial['cue_dir']]
+            corner = (int(round(cue_x - arrow.size[0]/2.0)),
+                      int(round(cue_y - arrow.size[1]/2.0)))
+            image.alpha_composite(arrow, corner)
+        elif trial['cue_type'] == 'word':
+            width, height = draw.textsize(trial['cue_dir'], font=self.font)
+            draw.text((cue_x - width/2.0, cue_y - height/2.0),
+                      trial['cue_dir'], fill='black', font=self.font)
+        else:
+            raise NotImplementedError('cue_type: %s' % trial['cue_type'])
+
+        target = Image.new('RGBA', self.size, (0, 0, 0, 0))
+        x, y = self.to_image((float(trial['target_pos_x']),
+                              float(trial['target_pos_y'])))
+        radius = self.target_radius
+        ImageDraw.Draw(target).ellipse(
+            [x - radius, y - radius, x + radius, y + radius],
+            fill=(0, 0, 0, int(255 * self.target_opacity)),
+        )
+        image.alpha_composite(target)
+
+        return image.convert('RGB')
+
+
+def _init_worker(settings_yaml, size, font_file):
+    global _renderer
+    _renderer = TrialRenderer(settings_yaml, size, font_file)
+
+
+def _render_trial(args):
+    """ Save one trial and return its thumbnail for the contact sheet. """
+    trial, trial_png, thumb_scale = args
+    image = _renderer.render(trial)
+    if trial_png:
+        image.save(trial_png)
+
+    thumb_size = (int(image.size[0]*thumb_scale),
+                  int(image.size[1]*thumb_scale))
+    thumb = image.resize(thumb_size, Image.BILINEAR)
+    return int(trial['trial']), thumb.tobytes(), thumb_size
+
+
+def render_data_file(data_file, out_dir, pool, save_trials=True,
+                     thumb_scale=0.1, columns=20):
+    """ Render every trial in a data file and make a contact sheet. """
+    data_file = unipath.Path(data_file)
+    trials_dir = unipath.Path(out_dir, data_file.stem)
+    if save_trials and not trials_dir.exists():
+        trials_dir.mkdir(parents=True)
+
+    with open(data_file, 'r') as f:
+        trials = list(csv.DictReader(f))
+
+    jobs = []
+    for trial in trials:
+        trial_png = None
+        if save_trials:
+            trial_png = unipath.Path(
+                trials_dir, 'trial-{:03d}.png'.format(int(trial['trial']))
+            )
+        jobs.append((trial, trial_png, thumb_scale))
+
+    thumbs = sorted(pool.imap(_render_trial, jobs, chunksize=8))
+
+    if not thumbs:
+        return None
+
+    thumb_w, thumb_h = thumbs[0][2]
+    rows = (len(thumbs) + columns - 1)/columns
+    sheet = Image.new('RGB', (thumb_w*columns, thumb_h*rows), 'white')
+    draw = ImageDraw.Draw(sheet)
+    for ix, (trial_num, thumb_bytes, thumb_size) in enumerate(thumbs):
+        x, y = (ix % columns)*thumb_w, (ix / columns)*thumb_h
+        sheet.paste(Image.frombytes('RGB', thumb_size, thumb_bytes), (x, y))
+        draw.text((x + 2, y + 2), str(trial_num), fill='white')
+
+    sheet_png = unipath.Path(out_dir, '{}-contact.png'.format(data_file.stem))
+    sheet.save(sheet_png)
+    return sheet_png
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('data_files', nargs='+')
+    parser.add_argument('--out', default='renders')
+    parser.add_argument('--settings', default='settings.yaml')
+    parser.add_argument('--size', type=int, nargs=2, default=[1920, 1080],
+                        help='width and height of the lab monitors in pixels')
+    parser.add_argument('--font',
+                        help='font file to use instead of font_file in '
+                             'settings, e.g. /usr/share/fonts/consola.ttf')
+    parser.add_argument('--processes', type=int)
+    parser.add_argument('--contact-only', action='store_true',
+                        help='only save the contact sheets')
+
+    args = parser.parse_args()
+
+    # Fail here rather than in every worker if the font can't be opened
+    TrialRenderer(args.settings, args.size, args.font)
+
+    out_dir = unipath.Path(args.out)
+    if not out_dir.exists():
+        out_dir.mkdir(parents=True)
+
+    pool = Pool(args.processes, initializer=_init_worker,
+                initargs=(args.settings, args.size, args.font))
+    try:
+        for data_file in args.data_files:
+            sheet_png = render_data_file(data_file, out_dir, pool,
+                                         save_trials=not args.contact_only)
+            print('{} -> {}'.format(data_file, sheet_png))
+    finally:
+        pool.close()
+        pool.join()
@@ -1,4 +1,5 @@
 #!/usr/bin/env python
+import socket
 from UserDict import UserDict
 from UserList import UserList
 
@@ -10,12 +11,20 @@ import yaml
 from psychopy import visual, core, event, sound
 
 from labtools.psychopy_helper import get_subj_info
+from labtools.data_validation import validate_data_dir
+from labtools.seed_index import build_seed_index, used_seeds, SeedAllocator
+from labtools.profiling import PhaseProfiler
+from labtools.realtime import RealtimeMode, measure_jitter
+from labtools.session_log import SessionLog, export_csv
 from labtools.trials_functions import expand, extend, add_block
 
+import orchestrator as orch
+
 
 class Participant(UserDict):
     """ Store participant data and provide helper functions. """
     DATA_DIR = 'data'
+    LOG_DIR = 'logs'
     DATA_DELIMITER = ','
 
     def __init__(self, **kwargs):
@@ -25,6 +34,7 @@ class Participant(UserDict):
         isn't exhaustive of kwargs.
         """
         self._data_file = None
+        self._log = None
         self._order = kwargs.pop('_order', kwargs.keys())
 
         correct_len = len(self._order) == len(kwargs)
@@ -43,18 +53,40 @@ class Participant(UserDict):
             self._data_file = unipath.Path(self.DATA_DIR, data_file_name)
         return self._data_file
 
-    def write_header(self, trial_col_names):
-        """ Writes the names of the columns and saves the order. """
+    @property
+    def log_file(self):
+        # Kept out of DATA_DIR, where compile.R reads every file
+        if not unipath.Path(self.LOG_DIR).exists():
+            unipath.Path(self.LOG_DIR).mkdir()
+        return unipath.Path(self.LOG_DIR, '{subj_id}.bin'.format(**self))
+
+    def write_header(self, trial_col_names, dtypes=None):
+        """ Writes the names of the columns and saves the order.
+
+        If dtypes are provided, trials are also appended to a binary session
+        log in LOG_DIR.
+        """
         self._col_names = self._order + trial_col_names
         self._write_line(self.DATA_DELIMITER.join(self._col_names))
+        if dtypes is not None:
+            self._log = SessionLog(self.log_file, dict(self), self._order,
+                                   trial_col_names, dtypes)
 
     def write_trial(self, trial):
         assert self._col_names, 'write header first to save column order'
+        if self._log:
+            self._log.append(trial)
+
         trial_data = dict(self)
         trial_data.update(trial)
         row_data = [str(trial_data[key]) for key in self._col_names]
         self._write_line(self.DATA_DELIMITER.join(row_data))
 
+    def close(self):
+        """ Close the binary session log, if there is one. """
+        if self._log:
+            self._log.close()
+
     def _write_line(self, row):
         with open(self.data_file, 'a') as f:
             f.write(row + '\n')
@@ -82,6 +114,36 @@ class Trials(UserList):
         'rt',
         'is_correct',
     ]
+    # Allowed values of the categorical columns
+    CATEGORIES = dict(
+        block_type=['practice', 'test'],
+        cue_type=['arrow', 'word'],
+        cue_validity=['valid', 'invalid'],
+        cue_dir=['left', 'right'],
+        target_loc=['left', 'right'],
+        correct_response=['left', 'right'],
+        response=['left', 'right', 'timeout'],
+        is_correct=['0', '1'],
+    )
+    # Types of the columns in the binary session log
+    DTYPES = dict(
+        block='int',
+        block_type=CATEGORIES['block_type'],
+        trial='int',
+        cue_type=CATEGORIES['cue_type'],
+        cue_validity=CATEGORIES['cue_validity'],
+        cue_dir=CATEGORIES['cue_dir'],
+        cue_pos_dy='float',
+        target_loc=CATEGORIES['target_loc'],
+        target_pos_dy='float',
+        correct_response=CATEGORIES['correct_response'],
+        cue_pos_y='float',
+        target_pos_x='float',
+        target_pos_y='float',
+        response=CATEGORIES['response'],
+        rt='float',
+        is_correct='int',
+    )
 
     @classmethod
     def make(cls, **kwargs):
@@ -139,6 +201,41 @@ class Trials(UserList):
 
         return cls(trials.to_dict('record'))
 
+    def summarize(self):
+        """ Summarize the design properties used to balance seeds.
+
+        Blocks are compared to the valid ratio of all test trials rather
+        than to ratio_cue_valid. expand makes 4 valid to 2 invalid trials,
+        and the practice trials are drawn out of the test trials, which
+        moves the test ratio slightly away from 2/3.
+        """
+        trials = pandas.DataFrame.from_records(self)
+        summary = {}
+
+        valid_devs = []
+        lr_imbalances = []
+        test_trials = trials[trials.block_type == 'test']
+        ratio_cue_valid = (test_trials.cue_validity == 'valid').mean()
+        summary['valid'] = ratio_cue_valid
+        for block, block_trials in test_trials.groupby('block'):
+            valid = (block_trials.cue_validity == 'valid').mean()
+            left = (block_trials.target_loc == 'left').sum()
+            right = (block_trials.target_loc == 'right').sum()
+            summary['block{}_valid'.format(block)] = valid
+            summary['block{}_left'.format(block)] = left
+            summary['block{}_right'.format(block)] = right
+            valid_devs.append(abs(valid - ratio_cue_valid))
+            lr_imbalances.append(abs(left - right)/float(len(block_trials)))
+
+        practice = trials[trials.block_type == 'practice']
+        summary['practice_valid'] = (practice.cue_validity == 'valid').sum()
+        summary['practice_left'] = (practice.target_loc == 'left').sum()
+        summary['practice_arrow'] = (practice.cue_type == 'arrow').sum()
+
+        summary['max_valid_dev'] = max(valid_devs)
+        summary['max_lr_imbalance'] = max(lr_imbalances)
+        return summary
+
     def write(self, trials_csv='sample_trials.csv'):
         trials = pandas.DataFrame.from_records(self)
         trials = trials[self.COLUMNS]
@@ -160,7 +257,12 @@ class Trials(UserList):
 class Experiment(object):
     STIM_DIR = 'stimuli'
 
-    def __init__(self, settings_yaml='settings.yaml', texts_yaml='texts.yaml'):
+    def __init__(self, settings_yaml='settings.yaml', texts_yaml='texts.yaml',
+                 profiler=None, realtime=False):
+        # Profiling is never done around stimulus presentation.
+        self.profiler = profiler or PhaseProfiler(enabled=False)
+        self.realtime = RealtimeMode(enabled=realtime)
+
         with open(settings_yaml, 'r') as f:
             settings = yaml.load(f)
 
@@ -169,23 +271,26 @@ class Experiment(object):
         self.survey_url = settings.pop('survey_url')
         layout = settings.pop('layout')
         self.positions = layout.pop('positions')
+        stimuli = settings.pop('stimuli')
+        self.font = stimuli['font']
 
         with open(texts_yaml, 'r') as f:
             self.texts = yaml.load(f)
 
-        self.win = visual.Window(fullscr=True, allowGUI=False, units='pix')
+        self.win = visual.Window(fullscr=True, allowGUI=False, units='pix',
+                                 color=stimuli['background'])
 
-        text_kwargs = dict(win=self.win, font='Consolas', color='black',
-                           height=30)
+        text_kwargs = dict(win=self.win, font=self.font, color='black',
+                           height=stimuli['text_height'])
         self.fix = visual.TextStim(text='+', **text_kwargs)
         self.prompt = visual.TextStim(text='?', **text_kwargs)
 
         word_kwargs = dict(text_kwargs)
-        word_kwargs['height'] = 30
         self.word = visual.TextStim(**word_kwargs)
 
-        self.target = visual.Circle(self.win, radius=10, fillColor='black',
-                                    lineColor=None, opacity=0.1)
+        self.target = visual.Circle(self.win, radius=stimuli['target_radius'],
+                                    fillColor='black', lineColor=None,
+                                    opacity=stimuli['target_opacity'])
 
         self.arrows = {}
         for direction in ['left', 'right']:
@@ -199,7 +304,8 @@ class Experiment(object):
             win=self.win,
             width=layout['frame_size'],
             height=layout['frame_size'],
-            lineColor='black'
+            lineColor='black',
+            lineWidth=stimuli['line_width'],
         )
         self.frames = []
         for direction in ['left', 'right']:
@@ -226,36 +332,73 @@ class Experiment(object):
 
         self.timer = core.Clock()
 
+        prerender_timer = core.Clock()
+        self._prerender_screens()
+        print('Pre-rendered screens in {:.3f} s'.format(
+            prerender_timer.getTime()))
+
+    def _prerender_screens(self):
+        """ Lay out the text of every screen once, before the experiment.
+
+        Each stimulus is drawn once to the back buffer so it is ready to draw
+        when needed, and the buffer is cleared before anything is shown.
+        """
+        self.screens = {}
+        for name, text in self.texts.items():
+            if name == 'instructions':
+                continue
+            self.screens[name] = visual.TextStim(text=text,
+                                                 **self.screen_text_kwargs)
+
+        main_kwargs = dict(self.screen_text_kwargs)
+        main_kwargs['height'] = 25
+        main_kwargs['pos'] = (0, 350)
+        self.instructions = []
+        for num, text in sorted(self.texts['instructions'].items()):
+            page = visual.TextStim(text=text, **main_kwargs)
+            self.instructions.append((num, page))
+
+        for screen in self.screens.values():
+            screen.draw()
+        for _, page in self.instructions:
+            page.draw()
+        self.win.clearBuffer()
+
     def run_trial(self, trial):
-        cue_type = trial['cue_type']
-        cue_dir = trial['cue_dir']
-        if cue_type == 'arrow':
-            cue = self.arrows[cue_dir]
-        elif cue_type == 'word':
-            cue = self.word
-            cue.setText(cue_dir)
-        else:
-            raise NotImplementedError('cue_type: %s' % cue_type)
+        # Ends before presentation, so no flips are profiled.
+        with self.profiler.phase('trial_setup'):
+            cue_type = trial['cue_type']
+            cue_dir = trial['cue_dir']
+            if cue_type == 'arrow':
+                cue = self.arrows[cue_dir]
+            elif cue_type == 'word':
+                cue = self.word
+                cue.setText(cue_dir)
+            else:
+                raise NotImplementedError('cue_type: %s' % cue_type)
 
-        # Determine vertical cue location
-        trial['cue_pos_y'] = self.project(trial['cue_pos_dy'])
-        trial['target_pos_y'] = self.project(trial['target_pos_dy'])
-        trial['target_pos_x'] = self.uniform_x(trial['target_loc'])
+            # Determine vertical cue location
+            trial['cue_pos_y'] = self.project(trial['cue_pos_dy'])
+            trial['target_pos_y'] = self.project(trial['target_pos_dy'])
+            trial['target_pos_x'] = self.uniform_x(trial['target_loc'])
 
-        cue_pos = (0, trial['cue_pos_y'])
-        cue.setPos(cue_pos)
+            cue_pos = (0, trial['cue_pos_y'])
+            cue.setPos(cue_pos)
 
-        target_pos = (trial['target_pos_x'], trial['target_pos_y'])
-        self.target.setPos(target_pos)
+            target_pos = (trial['target_pos_x'], trial['target_pos_y'])
+            self.target.setPos(target_pos)
 
-        cue_offset_to_target_onset = self.waits['cue_onset_to_target_onset'] -\
-            self.waits['cue_duration']
+            cue_offset_to_target_onset = (
+                self.waits['cue_onset_to_target_onset'] -
+                self.waits['cue_duration']
+            )
 
-        for frame in self.frames:
-            frame.autoDraw = True
+            for frame in self.frames:
+                frame.autoDraw = True
 
         # Begin trial presentation
         # ------------------------
+        self.realtime.begin_presentation()
         self.fix.draw()
         self.win.flip()
         core.wait(self.waits['fixation_duration'])
@@ -284,22 +427,26 @@ class Experiment(object):
         for frame in self.frames:
             frame.autoDraw = False
         self.win.flip()
+        self.realtime.end_presentation()
         # ----------------------
         # End trial presentation
+        trial.update(self.realtime.status())
+
+        # Profiling phases never include feedback, screens, or waits.
+        with self.profiler.phase('iti'):
+            try:
+                key, rt = response[0]
+            except TypeError:
+                rt = self.waits['response_window']
+                response = 'timeout'
+            else:
+                response = self.response_keys[key]
 
-        try:
-            key, rt = response[0]
-        except TypeError:
-            rt = self.waits['response_window']
-            response = 'timeout'
-        else:
-            response = self.response_keys[key]
-
-        is_correct = int(response == trial['correct_response'])
+            is_correct = int(response == trial['correct_response'])
 
-        trial['response'] = response
-        trial['rt'] = rt * 1000
-        trial['is_correct'] = is_correct
+            trial['response'] = response
+            trial['rt'] = rt * 1000
+            trial['is_correct'] = is_correct
 
         if trial['block_type'] == 'practice' or response == 'timeout':
             self.feedback[is_correct].play()
@@ -307,6 +454,9 @@ class Experiment(object):
         if response == 'timeout':
             self.show_screen('timeout')
 
+        with self.profiler.phase('iti'):
+            self.realtime.collect()
+
         core.wait(self.waits['iti'])
 
         return trial
@@ -314,13 +464,13 @@ class Experiment(object):
     def show_screen(self, name):
         if name == 'instructions':
             self._show_instructions()
-        elif name in self.texts:
-            self._show_screen(text=self.texts[name])
+        elif name in self.screens:
+            self._show_screen(self.screens[name])
         else:
             raise NotImplementedError('%s is not a valid screen' % name)
 
-    def _show_screen(self, text):
-        visual.TextStim(text=text, **self.screen_text_kwargs).draw()
+    def _show_screen(self, screen):
+        screen.draw()
         self.win.flip()
         response = event.waitKeys(keyList=['space', 'q'])[0]
 
@@ -328,16 +478,8 @@ class Experiment(object):
             core.quit()
 
     def _show_instructions(self):
-        instructions = sorted(self.texts['instructions'].items())
-
-        main_kwargs = dict(self.screen_text_kwargs)
-        main_kwargs['height'] = 25
-        main_kwargs['pos'] = (0, 350)
-
-        main = visual.TextStim(**main_kwargs)
-        for num, text in instructions:
-            main.setText(text)
-            main.draw()
+        for num, page in self.instructions:
+            page.draw()
 
             advance_keys = ['space', 'q']
 
@@ -367,10 +509,10 @@ class Experiment(object):
 
     @property
     def screen_text_kwargs(self):
-        if not hasattr(self, 'screen_text_kwargs'):
+        if not hasattr(self, '_screen_text_kwargs'):
             self._screen_text_kwargs = dict(
                 win=self.win,
-                font='Consolas',
+                font=self.font,
                 color='black',
                 height=30,
                 wrapWidth=800,
@@ -378,33 +520,163 @@ class Experiment(object):
         return self._screen_text_kwargs
 
 
-def main():
+def validate(data_dir, gui_yaml='gui.yaml', expected_rows=None):
+    """ Check the data files before analysis. Returns the number of invalid
+    files, which is also reported along with each problem found.
+
+    The number of rows is only checked if expected_rows is given. It varies
+    between seeds, because practice trials are sampled with replacement,
+    and iter_blocks never yields the last block.
+    """
+    with open(gui_yaml, 'r') as f:
+        gui_info = yaml.load(f)
+    # Fixed fields are added after the gui fields by get_subj_info
+    participant_cols = [field['name'] for _, field in sorted(gui_info.items())]
+    participant_cols += ['date', 'computer']
+
+    results = validate_data_dir(
+        data_dir,
+        columns=participant_cols + Trials.COLUMNS,
+        optional_columns=RealtimeMode.COLUMNS,
+        expected_rows=expected_rows,
+        categories=Trials.CATEGORIES,
+        unique='subj_id',
+    )
+
+    num_invalid = 0
+    for name, result in sorted(results.items()):
+        problems = result['errors'] + result['duplicates']
+        if problems:
+            num_invalid += 1
+        for problem in problems:
+            print('{}: {}'.format(name, problem))
+    print('{} files checked, {} invalid'.format(len(results), num_invalid))
+    return num_invalid
+
+
+def benchmark(n=600):
+    """ Compare frame timing jitter with and without real-time mode.
+
+    The default mode is measured first, since priority and cpu affinity
+    stay in place once real-time mode has been enabled.
+    """
+    import numpy
+    experiment = Experiment()
+    stims = experiment.frames + [experiment.arrows['left'], experiment.fix,
+                                 experiment.target]
+    for enabled in [False, True]:
+        realtime = RealtimeMode(enabled=enabled)
+        intervals = numpy.array(
+            measure_jitter(realtime, experiment.win, stims, n)
+        )
+        dropped = (intervals > 1.5 * numpy.median(intervals)).sum()
+        label = 'realtime' if enabled else 'default'
+        print('{:8s} sd={:.3f} ms max={:.3f} ms dropped={} {}'.format(
+            label, intervals.std(), intervals.max(), dropped,
+            realtime.status()))
+    experiment.win.close()
+
+
+def make_seed_index(num_seeds, index_csv='seeds.csv'):
+    """ Save the design properties of the trials made by each seed, and
+    report how many seeds meet the balance criteria in settings.
+    """
+    index = build_seed_index(
+        make_trials=lambda seed: Trials.make(seed=seed),
+        summarize=Trials.summarize,
+        seeds=range(1, num_seeds + 1),
+        index_csv=index_csv,
+    )
+    allocator = load_seed_allocator(index)
+    print('{} of {} seeds meet seed_balance'.format(len(allocator),
+                                                    len(index)))
+    return index
+
+
+def load_seed_allocator(index='seeds.csv', settings_yaml='settings.yaml',
+                        used=None):
+    """ Allocate seeds from the index using the criteria in settings. """
+    with open(settings_yaml, 'r') as f:
+        seed_balance = yaml.load(f)['seed_balance']
+    return SeedAllocator(index, max_values=seed_balance, used=used)
+
+
+def main(orchestrator=None, index_csv='seeds.csv', profile=False,
+         profile_phases=None, realtime=False, binary_log=False):
+    # When an orchestrator is running, it assigns the subj_id and seed.
+    # Otherwise the seed comes from the seed index, if one has been made.
+    defaults = None
+    fixed = None
+    if orchestrator:
+        station = socket.gethostname()
+        while True:
+            assignment = orch.checkout(orchestrator, station=station)
+            assigned = Participant(subj_id=assignment['subj_id'])
+            if not (assigned.data_file.exists() or
+                    assigned.log_file.exists()):
+                break
+            # Checking out again abandons the session with the local id.
+            print('{} already has data on this station, checking out '
+                  'another subj_id'.format(assignment['subj_id']))
+        defaults = dict(subj_id=assignment['subj_id'],
+                        seed=assignment['seed'])
+        # The orchestrator only accepts data for the subj_id it assigned
+        fixed = ['subj_id', 'seed']
+    elif unipath.Path(index_csv).exists():
+        allocator = load_seed_allocator(
+            index_csv,
+            used=used_seeds(Participant.DATA_DIR, Participant.LOG_DIR),
+        )
+        # Seeds are only used up once a data file has been written.
+        try:
+            defaults = dict(seed=allocator.peek())
+        except ValueError:
+            print('Warning: no unused balanced seeds left in {}, using the '
+                  'last seed instead. Run makeseeds with more '
+                  '--num-seeds.'.format(index_csv))
+
     participant_data = get_subj_info(
         'gui.yaml',
         # check_exists is a simple function to determine if the data file
         # exists, provided subj_info data. It's used to validate the data
         # entered in the gui.
         check_exists=lambda subj_info:
-            Participant(**subj_info).data_file.exists()
+            Participant(**subj_info).data_file.exists() or
+            Participant(**subj_info).log_file.exists(),
+        defaults=defaults,
+        fixed=fixed,
     )
 
     participant = Participant(**participant_data)
     trials = Trials.make(**participant)
     last_block_num = trials[-1]['block']
 
+    profiler = PhaseProfiler(enabled=profile, phases=profile_phases)
+
     # Start of experiment
-    experiment = Experiment('settings.yaml', 'texts.yaml')
+    experiment = Experiment('settings.yaml', 'texts.yaml', profiler=profiler,
+                            realtime=realtime)
     experiment.show_screen('instructions')
 
-    participant.write_header(trials.COLUMNS)
+    columns = list(trials.COLUMNS)
+    dtypes = dict(trials.DTYPES)
+    if realtime:
+        # Record whether each real-time control applied on every trial
+        columns += RealtimeMode.COLUMNS
+        dtypes.update({name: 'int' for name in RealtimeMode.COLUMNS})
+    participant.write_header(columns, dtypes=dtypes if binary_log else None)
 
     for block in trials.iter_blocks():
         block_num = block[0]['block']
         block_type = block[0]['block_type']
+        profiler.block = block_num
 
         for trial in block:
             trial_data = experiment.run_trial(trial)
-            participant.write_trial(trial_data)
+            with profiler.phase('inter_trial'):
+                participant.write_trial(trial_data)
+
+        experiment.realtime.collect()
 
         if block_type == 'practice':
             experiment.show_screen('end_of_practice')
@@ -412,6 +684,14 @@ def main():
             experiment.show_screen('break')
 
     experiment.show_screen('end_of_experiment')
+    participant.close()
+
+    if profile:
+        profiler.write('profiles', prefix=participant['subj_id'])
+
+    if orchestrator:
+        orch.submit(orchestrator, station, assignment['subj_id'],
+                    participant.data_file)
 
     import webbrowser
     webbrowser.open(experiment.survey_url.format(**participant))
@@ -421,9 +701,30 @@ if __name__ == '__main__':
     import argparse
     parser = argparse.ArgumentParser()
     command_choices = ['main', 'maketrials', 'singletrial', 'instructions',
-                       'survey']
+                       'survey', 'validate', 'makeseeds', 'benchmark',
+                       'export']
     parser.add_argument('command', choices=command_choices,
                         nargs='?', default=command_choices[0])
+    parser.add_argument('--orchestrator',
+                        help='host:port of orchestrator.py assigning sessions')
+    parser.add_argument('--data-dir', default=Participant.DATA_DIR,
+                        help='directory of data files to validate or export')
+    parser.add_argument('--log-dir', default=Participant.LOG_DIR,
+                        help='directory of binary session logs to export')
+    parser.add_argument('--expected-rows', type=int,
+                        help='number of trials in a complete data file, '
+                             'only checked if given')
+    parser.add_argument('--profile', action='store_true',
+                        help='profile the code between stimulus presentations')
+    parser.add_argument('--profile-phases', nargs='+',
+                        choices=['trial_setup', 'iti', 'inter_trial'],
+                        help='only profile these phases')
+    parser.add_argument('--realtime', action='store_true',
+                        help='disable gc and raise priority during trials')
+    parser.add_argument('--binary-log', action='store_true',
+                        help='also log trials in binary, in --log-dir')
+    parser.add_argument('--num-seeds', type=int, default=1000,
+                        help='number of seeds to include in the seed index')
 
     default_trial_options = dict(
         cue_type='arrow',
@@ -460,5 +761,22 @@ if __name__ == '__main__':
         import webbrowser
         webbrowser.open(experiment.survey_url.format(subj_id='TESTSUBJ', computer='TESTCOMPUTER'))
         core.quit()
+    elif args.command == 'validate':
+        import sys
+        num_invalid = validate(args.data_dir,
+                               expected_rows=args.expected_rows)
+        sys.exit(1 if num_invalid else 0)
+    elif args.command == 'makeseeds':
+        make_seed_index(args.num_seeds)
+    elif args.command == 'benchmark':
+        benchmark()
+    elif args.command == 'export':
+        # Only logs without a csv, e.g. if the csv was lost
+        for log_file in unipath.Path(args.log_dir).listdir('*.bin'):
+            data_file = unipath.Path(args.data_dir, log_file.stem + '.csv')
+            if not data_file.exists():
+                export_csv(log_file, data_file, Participant.DATA_DELIMITER)
     else:
-        main()
+        main(orchestrator=args.orchestrator, profile=args.profile,
+             profile_phases=args.profile_phases, realtime=args.realtime,
+             binary_log=args.binary_log)
@@ -0,0 +1,160 @@
+""" Clean and recode the compiled data into model-ready matrices.
+
+Mirrors compile.R, clean.R, and recode.R, so models can be fit without
+repeating those steps on every run. Outputs are cached by a hash of the
+data files, so the cleaning only runs again when the data change.
+
+    python model_matrix.py ../../experiment/data --out model-data --sparse
+
+Writes to model-data/<hash>/, with the same rows in every file:
+    clean.parquet     cleaned and recoded trials
+    fixed.parquet     fixed effects for rt ~ cue_c * validity_c * deviation
+    responses.parquet rt and is_error, with rt_mask and error_mask marking
+                      the rows where each response is not NA
+    design.npz        (--sparse) fixed effects and subject indicators as a
+                      scipy.sparse matrix, with design.json naming the columns
+
+The hash covers the data files and this module, so changes to the cleaning
+code also invalidate the cache.
+"""
+import glob
+import hashlib
+import itertools
+import json
+import os
+
+import numpy as np
+import pandas
+
+# Contrast codes from recode.R
+CUE_C = {'arrow': -0.5, 'word': 0.5}
+VALIDITY_C = {'invalid': -0.5, 'valid': 0.5}
+
+PREDICTORS = ['cue_c', 'validity_c', 'deviation']
+
+
+def compile_data(data_files):
+    """ Load and stack the data files, as in compile.R. """
+    return pandas.concat([pandas.read_csv(f) for f in data_files],
+                         ignore_index=True)
+
+
+def clean(frame):
+    """ Vectorized version of clean.R. """
+    frame = frame[frame.block_type != 'practice'].copy()
+
+    # Drop RT on incorrect response trials
+    frame['rt'] = frame.rt.where(frame.is_correct == 1)
+
+    # Drop accuracy on timeout trials
+    frame['is_correct'] = frame.is_correct.where(frame.response != 'timeout')
+
+    # Create is_error from is_correct
+    frame['is_error'] = 1 - frame.is_correct
+
+    # Calculate deviation
+    frame['deviation'] = (frame.cue_pos_dy - frame.target_pos_dy).abs()
+
+    return frame.reset_index(drop=True)
+
+
+def recode(frame):
+    """ Join the contrast codes, as in recode.R. """
+    frame = frame.copy()
+    frame['cue_c'] = frame.cue_type.map(CUE_C)
+    frame['validity_c'] = frame.cue_validity.map(VALIDITY_C)
+    return frame
+
+
+def fixed_effects(frame, predictors=PREDICTORS):
+    """ Intercept, main effects, and all interactions of the predictors. """
+    fixed = pandas.DataFrame({'(Intercept)': np.ones(len(frame))})
+    for order in range(1, len(predictors) + 1):
+        for terms in itertools.combinations(predictors, order):
+            name = ':'.join(terms)
+            fixed[name] = np.prod([frame[t].values for t in terms], axis=0)
+    return fixed
+
+
+def sparse_design(frame, fixed, group='subj_id'):
+    """ Fixed effects alongside sparse indicators for each subject. """
+    from scipy import sparse
+
+    groups, group_ix = np.unique(frame[group].values, return_inverse=True)
+    indicators = sparse.csr_matrix(
+        (np.ones(len(frame)), (np.arange(len(frame)), group_ix)),
+        shape=(len(frame), len(groups)),
+    )
+    design = sparse.hstack([sparse.csr_matrix(fixed.values), indicators],
+                           format='csr')
+    columns = list(fixed.columns) + ['{}{}'.format(group, g) for g in groups]
+    return design, columns
+
+
+def responses(frame):
+    """ Response vectors, with masks of the rows each model can use. """
+    return pandas.DataFrame({
+        'subj_id': frame.subj_id,
+        'rt': frame.rt,
+        'rt_mask': frame.rt.notnull(),
+        'is_error': frame.is_error,
+        'error_mask': frame.is_error.notnull(),
+    }, columns=['subj_id', 'rt', 'rt_mask', 'is_error', 'error_mask'])
+
+
+def hash_data_files(data_files):
+    """ Hash this module and the names and contents of the data files. """
+    digest = hashlib.sha1()
+    module_py = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+    with open(module_py, 'rb') as f:
+        digest.update(f.read())
+    for data_file in sorted(data_files):
+        digest.update(os.path.basename(data_file).encode('utf-8'))
+        with open(data_file, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def make_model_data(data_dir, out_dir='model-data', sparse=False):
+    """ Write the model-ready data, unless the data haven't changed.
+
+    :return: str. Directory containing the outputs for these data.
+    """
+    data_files = glob.glob(os.path.join(data_dir, '*.csv'))
+    cache_dir = os.path.join(out_dir, hash_data_files(data_files))
+
+    clean_parquet = os.path.join(cache_dir, 'clean.parquet')
+    design_npz = os.path.join(cache_dir, 'design.npz')
+    if os.path.exists(clean_parquet) and \
+            (not sparse or os.path.exists(design_npz)):
+        return cache_dir
+
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    frame = recode(clean(compile_data(data_files)))
+    fixed = fixed_effects(frame)
+    fixed.to_parquet(os.path.join(cache_dir, 'fixed.parquet'))
+    responses(frame).to_parquet(os.path.join(cache_dir, 'responses.parquet'))
+
+    if sparse:
+        from scipy.sparse import save_npz
+        design, columns = sparse_design(frame, fixed)
+        save_npz(design_npz, design)
+        with open(os.path.join(cache_dir, 'design.json'), 'w') as f:
+            json.dump(columns, f)
+
+    # Written last, so it marks the cache as complete
+    frame.to_parquet(clean_parquet)
+    return cache_dir
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('data_dir')
+    parser.add_argument('--out', default='model-data')
+    parser.add_argument('--sparse', action='store_true',
+                        help='also write a sparse design with subject indicators')
+    args = parser.parse_args()
+    print(make_model_data(args.data_dir, args.out, sparse=args.sparse))